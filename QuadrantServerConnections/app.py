@@ -1,9 +1,10 @@
 # app.py
 import streamlit as st
 from client import (
-    upload_pdf, list_collections, create_collection,
-    delete_collection, query_collection
+    start_upload, get_job, list_collections, create_collection,
+    delete_collection, stream_query
 )
+from ui_helpers import init_session_state, refresh_collections
 import time
 
 # --- Page Configuration (MUST BE THE FIRST Streamlit command) ---
@@ -16,28 +17,13 @@ st.set_page_config(
 
 # --- Session State Initialization & Initial Checks ---
 # It's now SAFE to use st commands here because set_page_config already ran.
-if 'collections' not in st.session_state:
-    st.session_state.collections = list_collections()
-    # You can show a message here if needed, AFTER set_page_config
-    if not st.session_state.collections:
-        st.toast("Attempted to load collections: None found or backend connection failed.")
-
-# --- Helper Functions (Definition is fine anywhere before use) ---
-def refresh_collections():
-    """Function to refresh the list of collections."""
-    st.session_state.collections = list_collections()
-    # It's safe to use st.toast inside functions too, as long as the
-    # function itself is CALLED after set_page_config has run.
-    if not st.session_state.collections:
-         st.toast("Refreshed: No collections found or failed to connect.")
-    else:
-        st.toast("Collections list refreshed.")
+init_session_state()
 
 # --- Main UI Setup ---
 st.title("📄 DocuQuery: Document Understanding with Text + Images")
 
-# Use session state for collection list
-collections_list = st.session_state.get('collections', [])
+# Served from the client-side cache unless it expired or was cleared
+collections_list = list_collections()
 
 tab1, tab2, tab3 = st.tabs(["📁 Collection Manager", "⬆️ Upload PDF", "🔍 Query Collection"])
 
@@ -134,21 +120,37 @@ with tab2:
             # --- Process form submission ---
             if submitted: # Check if the form's submit button was pressed
                 if uploaded_file is not None and collection_to_upload_to:
-                    with st.spinner(f"Uploading and processing '{uploaded_file.name}'..."):
-                        response = upload_pdf(uploaded_file, collection_to_upload_to)
-                    if response is not None:
-                         if response.get("message"):
-                            st.success(f"Successfully processed '{uploaded_file.name}'!")
-                            # Display response outside the form if needed after rerun, or use st.toast
-                            # st.json(response) # This might disappear on rerun if inside form
-                            st.session_state.last_upload_response = response # Store if needed after clear
-                            # No need to manually clear or rerun, clear_on_submit handles it
-                         # Error/Warning messages handled by client.py
+                    with st.spinner(f"Uploading '{uploaded_file.name}'..."):
+                        response = start_upload(uploaded_file, collection_to_upload_to)
+                    if response is not None and response.get("job_id"):
+                        # Processing continues on the backend; the job is polled below after each rerun
+                        st.session_state.pending_job = {
+                            "job_id": response["job_id"],
+                            "file_name": uploaded_file.name,
+                        }
+                        st.toast(f"'{uploaded_file.name}' queued for processing.", icon="⏳")
+                    # Error/Warning messages handled by client.py
                 elif not collection_to_upload_to:
                      st.warning("Please select a collection.", icon="⚠️")
                 elif not uploaded_file:
                      st.warning("Please choose a PDF file.", icon="⚠️")
 
+        # --- Poll the background upload job, if any ---
+        pending_job = st.session_state.get('pending_job')
+        if pending_job:
+            job = get_job(pending_job["job_id"])
+            if job is None:
+                del st.session_state.pending_job # Error handled by client.py
+            elif job.get("status") in ("queued", "running"):
+                st.info(f"Processing '{pending_job['file_name']}' ({job['status']})...", icon="⏳")
+            elif job.get("status") == "completed":
+                st.success(f"Successfully processed '{pending_job['file_name']}'!")
+                st.session_state.last_upload_response = job.get("result")
+                del st.session_state.pending_job
+            else:
+                st.error(f"Processing '{pending_job['file_name']}' failed: {job.get('error', 'unknown error')}")
+                del st.session_state.pending_job
+
         # Optional: Display details from the last successful upload outside the form
         if 'last_upload_response' in st.session_state and st.session_state.last_upload_response:
              st.write("Last Upload Details:")
@@ -168,30 +170,47 @@ with tab3:
 
         if st.button("Submit Query"):
             if user_query and collection_to_query:
-                with st.spinner("Searching and generating answer..."):
-                    response = query_collection(user_query, collection_to_query)
+                st.session_state.pop('last_query_result', None)
+                response = {}
+                # Tokens are shown as they arrive; on success the placeholder gives way to the full answer rendered below
+                live_answer = st.empty()
+                with live_answer.container():
+                    with st.spinner("Searching and generating answer..."):
+                        st.write_stream(stream_query(user_query, collection_to_query, response))
 
                 if response:
-                    st.markdown("---")
-                    st.markdown("### 📌 Answer")
-                    st.info(response.get("answer", "No answer provided."))
-
-                    images = response.get("images")
-                    if images:
-                        st.markdown("### 🖼️ Retrieved Images (Score >= Threshold)")
-                        # Make columns slightly wider if needed
-                        num_cols = min(len(images), 4) # Display max 4 images per row
-                        cols = st.columns(num_cols)
-                        for i, img_bytes in enumerate(images):
-                            with cols[i % num_cols]:
-                                st.image(img_bytes, use_column_width=True) # use_column_width adapts to column size
-                    else:
-                         st.markdown("*(No relevant images found meeting the score threshold)*") # Updated message
+                    live_answer.empty()
+                    # Kept in session state so later reruns (typing, other tabs) redraw it without a new request
+                    st.session_state.last_query_result = {"question": user_query, "response": response}
                 else:
+                    st.session_state.pop('last_query_result', None)
                     st.error("Query failed. Please check the backend connection and logs.")
             elif not collection_to_query:
                  st.warning("Please select a collection.")
             else:
                 st.warning("Please enter a question.")
+
+        # --- Show the most recent answer ---
+        last_result = st.session_state.get('last_query_result')
+        if last_result:
+            response = last_result["response"]
+            st.markdown("---")
+            st.markdown("### 📌 Answer")
+            st.caption(last_result["question"])
+            st.info(response.get("answer", "No answer provided."))
+
+            images = response.get("images")
+            if images:
+                st.markdown("### 🖼️ Retrieved Images (Score >= Threshold)")
+                # One st.image call for the whole list; Streamlit lays the images out side by side
+                st.image(images, width=250)
+            else:
+                 st.markdown("*(No relevant images found meeting the score threshold)*") # Updated message
     else:
-        st.warning("Please create a collection and upload documents first.")
\ No newline at end of file
+        st.warning("Please create a collection and upload documents first.")
+
+# --- Keep polling while an upload job is in progress ---
+# Done last so every tab has rendered before the script sleeps and reruns.
+if st.session_state.get('pending_job'):
+    time.sleep(1)
+    st.rerun()
@@ -1,39 +1,76 @@
 # client.py
+import logging
+import threading
+from collections import OrderedDict
+from urllib.parse import quote
+import orjson
 import requests
-import base64
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import streamlit as st # Import streamlit for error display
 
 BASE_URL = "http://127.0.0.1:8000" # Use 127.0.0.1 consistent with server
+IMAGE_FETCH_WORKERS = 8 # Stays below the session's pool_maxsize
+IMAGE_CACHE_SIZE = 256 # Images kept in memory across queries and sessions
+
+logger = logging.getLogger(__name__)
+
+@st.cache_resource
+def get_session():
+    """One pooled keep-alive session per Streamlit process, so calls reuse TCP connections to the backend."""
+    session = requests.Session()
+    # urllib3 only retries idempotent methods (and connection failures), so uploads are never sent twice
+    adapter = HTTPAdapter(pool_connections=10, pool_maxsize=20, max_retries=Retry(total=2, backoff_factor=0.2))
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.headers.update({"Connection": "keep-alive"})
+    return session
 
 def handle_request_error(response: requests.Response, operation: str):
     """Handles common request errors and displays messages in Streamlit."""
     try:
         response.raise_for_status() # Raises HTTPError for bad responses (4xx or 5xx)
-        return response.json()
+        return orjson.loads(response.content)
     except requests.exceptions.ConnectionError as e:
         st.error(f"Connection Error during {operation}: Cannot connect to the backend at {BASE_URL}. Is it running?")
-        print(f"Connection Error: {e}")
+        logger.warning("Connection Error: %s", e)
         return None # Indicate failure
     except requests.exceptions.Timeout as e:
         st.error(f"Timeout Error during {operation}: The request timed out.")
-        print(f"Timeout Error: {e}")
+        logger.warning("Timeout Error: %s", e)
         return None
     except requests.exceptions.RequestException as e:
         st.error(f"Error during {operation}: {e}")
         try:
             # Try to get more details from response if available
-            detail = response.json().get("detail", response.text)
+            detail = orjson.loads(response.content).get("detail", response.text)
             st.error(f"Backend Detail: {detail}")
         except:
             pass # Ignore if response is not JSON or text is unavailable
-        print(f"Request Error: {e}")
+        logger.warning("Request Error: %s", e)
         return None
 
+class _ListCollectionsFailed(Exception):
+    """Raised inside the cached fetch so a failed lookup is never cached."""
+
+@st.cache_data(ttl=30, show_spinner=False)
+def _cached_list_collections():
+    response = get_session().get(f"{BASE_URL}/list_collections")
+    result = handle_request_error(response, "listing collections")
+    if result is None:
+        raise _ListCollectionsFailed()
+    return result.get("collections", [])
+
+def clear_collections_cache():
+    """Drops the cached collection list so the next call hits the backend."""
+    _cached_list_collections.clear()
+
 def list_collections():
     try:
-        response = requests.get(f"{BASE_URL}/list_collections")
-        result = handle_request_error(response, "listing collections")
-        return result.get("collections", []) if result else [] # Return empty list on error
+        return _cached_list_collections()
+    except _ListCollectionsFailed:
+        return [] # Error already shown by handle_request_error
     except Exception as e:
         # Catch potential errors before handle_request_error if request itself fails badly
         st.error(f"Failed to initiate request to list collections: {e}")
@@ -43,18 +80,25 @@ def create_collection(collection_name):
     if not collection_name or not collection_name.strip():
         st.error("Collection name cannot be empty.")
         return None
-    response = requests.post(f"{BASE_URL}/create_collection", json={"collection_name": collection_name})
-    return handle_request_error(response, f"creating collection '{collection_name}'")
+    response = get_session().post(f"{BASE_URL}/create_collection", json={"collection_name": collection_name})
+    result = handle_request_error(response, f"creating collection '{collection_name}'")
+    if result:
+        clear_collections_cache()
+    return result
 
 def delete_collection(collection_name):
     if not collection_name:
         st.error("No collection selected for deletion.")
         return None
     # Use json payload as expected by the refined endpoint
-    response = requests.delete(f"{BASE_URL}/delete_collection", json={"collection_name": collection_name})
-    return handle_request_error(response, f"deleting collection '{collection_name}'")
+    response = get_session().delete(f"{BASE_URL}/delete_collection", json={"collection_name": collection_name})
+    result = handle_request_error(response, f"deleting collection '{collection_name}'")
+    if result:
+        clear_collections_cache()
+    return result
 
-def upload_pdf(file, collection_name):
+def start_upload(file, collection_name):
+    """Queues a PDF for background processing. Returns {"job_id", "status"} or None."""
     if not file:
         st.error("No file selected.")
         return None
@@ -62,53 +106,118 @@ def upload_pdf(file, collection_name):
         st.error("No collection selected for upload.")
         return None
 
-    files = {'file': (file.name, file.getvalue(), file.type)} # Use getvalue() for bytes
+    file.seek(0)
+    files = {'file': (file.name, file, file.type)} # Pass the file object itself; requests reads it, no extra copy
     # Data needs to be passed separately for multipart/form-data
     data = {'collection_name': collection_name}
     try:
-        response = requests.post(f"{BASE_URL}/upload", files=files, data=data) # Endpoint is /upload/
+        response = get_session().post(f"{BASE_URL}/upload", files=files, data=data) # Endpoint is /upload/
         return handle_request_error(response, f"uploading PDF '{file.name}'")
     except Exception as e:
         st.error(f"Error during PDF upload request: {e}")
         return None
 
+def get_job(job_id):
+    """Fetches the status of a background upload job ("queued", "running", "completed" or "failed")."""
+    try:
+        response = get_session().get(f"{BASE_URL}/jobs/{job_id}")
+        return handle_request_error(response, "checking upload status")
+    except Exception as e:
+        st.error(f"Error while checking upload status: {e}")
+        return None
+
+
+class _ImageCache:
+    """Recently fetched image bytes by id (LRU). Ids are content digests, so an entry never goes stale."""
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._images = OrderedDict()
+        self._lock = threading.Lock()
 
-def query_collection(query, collection_name):
+    def get(self, image_id):
+        with self._lock:
+            image_bytes = self._images.get(image_id)
+            if image_bytes is not None:
+                self._images.move_to_end(image_id)
+            return image_bytes
+
+    def put(self, image_id, image_bytes):
+        with self._lock:
+            self._images[image_id] = image_bytes
+            self._images.move_to_end(image_id)
+            if len(self._images) > self.max_entries:
+                self._images.popitem(last=False)
+
+@st.cache_resource
+def get_image_cache():
+    return _ImageCache(IMAGE_CACHE_SIZE)
+
+def _download_image(session, image_id):
+    """Runs on a worker thread, so it must not call st.* (errors are returned instead)."""
+    try:
+        # Legacy ids are derived from PDF file names and may contain '#', '?' or spaces
+        response = session.get(f"{BASE_URL}/image/{quote(image_id, safe='')}")
+        response.raise_for_status()
+        return response.content, None
+    except Exception as e:
+        return None, e
+
+def fetch_images(image_ids):
+    """Downloads the retrieved images concurrently and returns their raw bytes in the original order."""
+    if not image_ids:
+        return []
+    cache = get_image_cache()
+    cached = {image_id: cache.get(image_id) for image_id in image_ids}
+    missing = [image_id for image_id, image_bytes in cached.items() if image_bytes is None]
+    if missing:
+        session = get_session()
+        with ThreadPoolExecutor(max_workers=min(IMAGE_FETCH_WORKERS, len(missing))) as executor:
+            downloads = list(executor.map(lambda image_id: _download_image(session, image_id), missing))
+        for image_id, (image_bytes, error) in zip(missing, downloads):
+            if error is not None:
+                logger.warning("Error fetching image '%s': %s", image_id, error)
+                st.warning(f"Could not load image '{image_id}' from the backend.")
+            else:
+                cache.put(image_id, image_bytes)
+                cached[image_id] = image_bytes
+
+    return [cached[image_id] for image_id in image_ids if cached.get(image_id) is not None]
+
+def stream_query(query, collection_name, result):
+    """Yields the answer as it is generated (for st.write_stream).
+
+    The backend streams Server-Sent Events: {"token": ...} frames, then one {"done": true, "image_ids": [...]}.
+    Once the stream ends, `result` holds "answer" and "images" (raw bytes fetched from /image/{id});
+    it is left empty if the query failed.
+    """
     if not query or not query.strip():
         st.warning("Please enter a query.")
-        return None # Or maybe {"answer": "Please enter a query.", "images": []}
+        return
     if not collection_name:
         st.error("No collection selected for query.")
-        return {"answer": "Error: No collection selected.", "images": []}
+        return
 
     payload = {
         "query": query,
         "collection_name": collection_name
     }
-    print(f"--- Sending Query ---") # DEBUG
-    print(f"URL: {BASE_URL}/query") # DEBUG
-    print(f"Method: POST")          # DEBUG
-    print(f"JSON Payload: {payload}") # DEBUG
+    logger.debug("Sending query: POST %s/query payload=%s", BASE_URL, payload)
+    answer_parts = []
     try:
-        response = requests.post(f"{BASE_URL}/query", json=payload)
-        result = handle_request_error(response, "querying collection")
-
-        if result and "images" in result and isinstance(result["images"], list):
-            # Decode base64 images if present
-            decoded_images = []
-            for img_str in result["images"]:
-                try:
-                    decoded_images.append(base64.b64decode(img_str))
-                except Exception as decode_error:
-                    print(f"Error decoding base64 image string: {decode_error}")
-                    st.warning("Received an invalid image format from the backend.")
-            result["images"] = decoded_images
-        elif result:
-             result["images"] = [] # Ensure images key exists even if empty
-
-        # Provide default structure on error
-        return result if result else {"answer": "Query failed. Check backend logs.", "images": []}
-
+        with get_session().post(f"{BASE_URL}/query", json=payload, stream=True) as response:
+            if not response.ok:
+                handle_request_error(response, "querying collection")
+                return
+            for line in response.iter_lines():
+                if not line.startswith(b"data: "):
+                    continue # Blank separators between frames
+                event = orjson.loads(line[len(b"data: "):])
+                if "token" in event:
+                    answer_parts.append(event["token"])
+                    yield event["token"]
+                elif event.get("done"):
+                    result["answer"] = "".join(answer_parts)
+                    result["images"] = fetch_images(event.get("image_ids"))
     except Exception as e:
         st.error(f"Error during query request: {e}")
-        return {"answer": f"Error sending query: {e}", "images": []}
\ No newline at end of file
@@ -1,53 +1,172 @@
 # main.py
 from fastapi import FastAPI, UploadFile, HTTPException, Form, Request
+from fastapi.responses import FileResponse, ORJSONResponse, StreamingResponse
 from pydantic import BaseModel
 from services.qdrant_connector import QdrantConnector
 from services.embedder import Embedder
 from services.pdf_processor import PDFProcessor
 from services.text_chunker import TextChunker
-from services.document_uploader import DocumentUploader
+from services.document_uploader import DocumentUploader, file_hasher
+from services.page_store import PageImageStore
+from services.query_cache import QueryCache
+from services.job_store import JobStore
+from qdrant_client import models
+import httpx
+import asyncio
+import mimetypes
 import os
+import tempfile
 import uvicorn
-import json
-import base64
-from typing import List
-import traceback
+import orjson
+import logging
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
 
 # --- Import Ollama LLM ---
 from langchain_ollama import OllamaLLM
 
-app = FastAPI()
-
 # --- Configuration ---
 QDRANT_URL = os.getenv("QDRANT_URL", "ai-lab.sagitec.com")
+QDRANT_GRPC_PORT = int(os.getenv("QDRANT_GRPC_PORT", "6334"))
 OLLAMA_URL = os.getenv("OLLAMA_BASE_URL", "http://ai-lab.sagitec.com:11434/")
 EMBED_MODEL = "all-minilm:33m"
 EMBEDDING_DIM = 1024
+# Layers of the embedding model Ollama offloads to the GPU (unset = Ollama decides) and how long
+# the model stays loaded between requests, in seconds
+EMBED_NUM_GPU = int(os.environ["EMBED_NUM_GPU"]) if os.getenv("EMBED_NUM_GPU") else None
+EMBED_KEEP_ALIVE = int(os.getenv("EMBED_KEEP_ALIVE", "1800"))
+# Chunks sent to Ollama per embed request during ingestion (one HTTP round-trip per batch)
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "64"))
+# Storage precision for new collections: "int8" (scalar quantization), "float16" or "float32"
+VECTOR_DTYPE = os.getenv("VECTOR_DTYPE", "int8")
+# With int8 quantization, fetch this many times `limit` candidates and rescore them with the original vectors
+QUANTIZATION_OVERSAMPLING = float(os.getenv("QUANTIZATION_OVERSAMPLING", "2.0"))
 LLM_MODEL = os.getenv("LLM_MODEL", "deepseek-r1:8b")
+# How long Ollama keeps the LLM loaded after a request; avoids reloading weights between queries
+LLM_KEEP_ALIVE = os.getenv("LLM_KEEP_ALIVE", "30m")
+# Set to the Ollama server's OLLAMA_NUM_PARALLEL (and keep its OLLAMA_MAX_LOADED_MODELS high enough for the LLM
+# and embedding model to stay loaded together, or they evict each other)
+OLLAMA_NUM_PARALLEL = int(os.getenv("OLLAMA_NUM_PARALLEL", "4"))
+# Identical on every request, so Ollama can reuse the KV cache for this prefix instead of re-prefilling it
+SYSTEM_PROMPT = (
+    "Based *only* on the following context retrieved from documents, please provide a concise answer "
+    "to the user's question. Do not use any prior knowledge. If the context does not contain the answer, say so."
+)
+# The per-request part of the prompt; the fixed instructions travel separately as SYSTEM_PROMPT
+PROMPT_TMPL = "Context:\n{context}\n\n---\nUser Question: {question}\n---\n\nAnswer:"
+# Fixed answers, built once rather than per request
+DEFAULT_NO_CTX = "No relevant information found in the documents."
+LLM_ERROR_PREFIX = "Error generating answer from context. Using raw context instead.\n\n"
+# Passed to the httpx clients of the embedder and the Ollama LLM so connections are pooled and reused
+OLLAMA_CLIENT_KWARGS = {
+    "limits": httpx.Limits(max_keepalive_connections=40, max_connections=100, keepalive_expiry=30),
+    "timeout": httpx.Timeout(120.0, connect=10.0),
+}
 DEFAULT_COLLECTION = "my_docs"
 IMAGE_DIR = "./stored_images"
+IMAGE_DIR_ABS = os.path.abspath(IMAGE_DIR) # Resolved once instead of per retrieved image
+# Re-sort extracted text into reading order (slower; only helps multi-column/odd layouts)
+SORT_PAGE_TEXT = os.getenv("SORT_PAGE_TEXT", "false").lower() == "true"
+# SQLite file shared by all workers: each page's image paths (chunks only store a page_id), ingested files,
+# upload jobs and query-cache generations. Kept out of IMAGE_DIR, which only holds served images.
+STATE_DB_PATH = os.getenv("STATE_DB_PATH", "./server_state.db")
 # --- Add Score Threshold Configuration ---
 # Adjust this value based on testing. Higher means stricter relevance required for images.
 # Assumes Cosine similarity (higher is better).
 SCORE_THRESHOLD = float(os.getenv("SCORE_THRESHOLD", "0.75"))
+# Optional floor for context chunks, applied inside Qdrant so weaker hits are never returned (unset = top-5 as is)
+CONTEXT_SCORE_THRESHOLD = float(os.environ["CONTEXT_SCORE_THRESHOLD"]) if os.getenv("CONTEXT_SCORE_THRESHOLD") else None
 # ---
+# How long finished upload jobs stay queryable
+JOB_RETENTION_SECONDS = int(os.getenv("JOB_RETENTION_SECONDS", "3600"))
+# Queued/running jobs older than this are reported as failed (their worker crashed or was restarted)
+JOB_STALE_SECONDS = int(os.getenv("JOB_STALE_SECONDS", "7200"))
+# Repeated questions are answered from memory; entries hold the full answer + images, so keep the count modest
+QUERY_CACHE_TTL = int(os.getenv("QUERY_CACHE_TTL", "3600"))
+QUERY_CACHE_SIZE = int(os.getenv("QUERY_CACHE_SIZE", "128"))
+# Uvicorn worker processes; each one has its own Qdrant/Ollama clients and query cache entries
+SERVER_WORKERS = int(os.getenv("SERVER_WORKERS", str(max(1, (os.cpu_count() or 2) // 2))))
+# Generations each worker sends to Ollama at once; extra queries wait here instead of piling onto the server.
+# The limit is per worker, so it is split across SERVER_WORKERS to keep the total near OLLAMA_NUM_PARALLEL.
+LLM_MAX_CONCURRENCY = max(1, OLLAMA_NUM_PARALLEL // SERVER_WORKERS)
+# Page-extraction processes per worker for large PDFs, so all workers together use about one per CPU
+PAGE_WORKERS = int(os.getenv("PAGE_WORKERS", str(max(1, (os.cpu_count() or 1) // SERVER_WORKERS))))
+# INFO logs one line per query/upload; DEBUG adds per-hit details
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
 # --- End Configuration ---
 
 # --- Initialization ---
+logging.basicConfig(level=LOG_LEVEL, format="%(asctime)s %(levelname)s [%(process)d] %(name)s: %(message)s")
+logger = logging.getLogger(__name__)
 os.makedirs(IMAGE_DIR, exist_ok=True)
 
-qdrant = QdrantConnector(url=QDRANT_URL, vector_size=EMBEDDING_DIM)
-embedder = Embedder(EMBED_MODEL, OLLAMA_URL)
-chunker = TextChunker()
-pdf_processor = PDFProcessor(IMAGE_DIR)
-uploader = DocumentUploader(qdrant, embedder, chunker, pdf_processor, DEFAULT_COLLECTION)
+# Clients are created per worker process in `lifespan` (gRPC channels and httpx pools must not be
+# shared across a fork); these module-level names are what the endpoints use once it has run.
+qdrant = None
+embedder = None
+# One pooled async connection set to Ollama per worker, shared by every /query embedding call
+ollama_http = None
+chunker = None
+pdf_processor = None
+page_store = None
+uploader = None
+llm = None
+llm_semaphore = None
+# Entries are per worker; their validity is checked against generation counters shared by all workers
+query_cache = None
+# Uploads run on this pool so /upload/ returns immediately; job state lives in `job_store`
+upload_executor = None
+# Shared by all workers, since a job may be polled through a different worker than the one running it
+job_store = None
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global qdrant, ollama_http, embedder, chunker, pdf_processor, page_store, uploader, llm
+    global query_cache, upload_executor, job_store, llm_semaphore
+
+    qdrant = QdrantConnector(
+        url=QDRANT_URL, vector_size=EMBEDDING_DIM, vector_dtype=VECTOR_DTYPE, grpc_port=QDRANT_GRPC_PORT
+    )
+    ollama_http = httpx.AsyncClient(**OLLAMA_CLIENT_KWARGS)
+    embedder = Embedder(
+        EMBED_MODEL, OLLAMA_URL, num_gpu=EMBED_NUM_GPU, keep_alive=EMBED_KEEP_ALIVE, client_kwargs=OLLAMA_CLIENT_KWARGS,
+        async_client=ollama_http,
+    )
+    chunker = TextChunker()
+    pdf_processor = PDFProcessor(IMAGE_DIR, sort_text=SORT_PAGE_TEXT, page_workers=PAGE_WORKERS)
+    page_store = PageImageStore(STATE_DB_PATH)
+    uploader = DocumentUploader(
+        qdrant, embedder, chunker, pdf_processor, page_store, DEFAULT_COLLECTION, embed_batch_size=EMBED_BATCH_SIZE
+    )
+    query_cache = QueryCache(STATE_DB_PATH, ttl_seconds=QUERY_CACHE_TTL, max_entries=QUERY_CACHE_SIZE)
+    # One ingest at a time per worker: PyMuPDF must not run on two threads of a process at once
+    # (large PDFs still fan out over page-range processes inside PDFProcessor.iter_pages)
+    upload_executor = ThreadPoolExecutor(max_workers=1)
+    job_store = JobStore(STATE_DB_PATH, retention_seconds=JOB_RETENTION_SECONDS, stale_seconds=JOB_STALE_SECONDS)
+    llm_semaphore = asyncio.Semaphore(LLM_MAX_CONCURRENCY)
 
-try:
-    llm = OllamaLLM(model=LLM_MODEL, base_url=OLLAMA_URL)
-    print(f"LLM initialized with model: {LLM_MODEL} from {OLLAMA_URL}")
-except Exception as e:
-    print(f"!!! ERROR initializing LLM: {e} !!!")
-    llm = None
+    try:
+        llm = OllamaLLM(model=LLM_MODEL, base_url=OLLAMA_URL, keep_alive=LLM_KEEP_ALIVE, client_kwargs=OLLAMA_CLIENT_KWARGS)
+        logger.info("LLM initialized with model: %s from %s", LLM_MODEL, OLLAMA_URL)
+    except Exception as e:
+        logger.error("Error initializing LLM: %s. Query augmentation disabled.", e)
+        llm = None
+
+    try:
+        yield
+    finally:
+        # Lets queued uploads finish before the worker exits
+        upload_executor.shutdown(wait=True)
+        pdf_processor.close()
+        await qdrant.get_async_client().close()
+        qdrant.get_client().close()
+        await embedder.aclose()
+        embedder.close()
+        await ollama_http.aclose()
+
+app = FastAPI(default_response_class=ORJSONResponse, lifespan=lifespan)
 
 # --- End Initialization ---
 
@@ -61,8 +180,66 @@ class QueryPayload(BaseModel):
 # --- End Pydantic Models ---
 
 
+# --- Upload Jobs ---
+def _run_upload_job(job_id: str, pdf_path: str, file_hash: str, filename: str, collection_name: str):
+    job_store.update(job_id, status="running", started_at=time.time())
+    try:
+        result = uploader.upload(pdf_path, file_hash, filename, collection_name)
+        query_cache.invalidate_collection(collection_name or DEFAULT_COLLECTION)
+        job_store.update(job_id, status="completed", result=result, finished_at=time.time())
+    except Exception as e:
+        logger.exception("Upload job %s failed", job_id)
+        job_store.update(job_id, status="failed", error=str(e), finished_at=time.time())
+    finally:
+        os.remove(pdf_path)
+
+def _write_upload_chunk(tmp, hasher, chunk: bytes):
+    hasher.update(chunk)
+    tmp.write(chunk)
+# --- End Upload Jobs ---
+
+
+# --- Query Helpers ---
+QUERY_PAYLOAD_FIELDS = ["text", "page_id", "associated_image_paths"]
+
+def _resolve_image_path(img_path: str) -> str:
+    """Maps a stored image path onto IMAGE_DIR, the only directory /image/{id} serves from."""
+    return os.path.join(IMAGE_DIR_ABS, os.path.basename(img_path))
+
+def _sse(event: dict) -> bytes:
+    """One Server-Sent Events frame. /query sends {"token": ...} frames, then a final {"done": true, "image_ids": [...]}."""
+    return b"data: " + orjson.dumps(event) + b"\n\n"
+
+async def _find_image_ids(collection_name: str, page_ids: list[str], candidate_image_paths: list[str]) -> list[str]:
+    """Ids of the images on `page_ids` plus any legacy inline paths that exist in IMAGE_DIR."""
+    image_ids = {}  # Ordered set of ids
+    if page_ids:
+        page_images = await asyncio.to_thread(page_store.get_images, collection_name, page_ids)
+        # Trusted without a stat: uploads write the files before saving a page's entry, and
+        # /reconcile_images drops entries whose files were removed afterwards
+        for page_id in page_ids:
+            image_ids.update((os.path.basename(img_path), None) for img_path in page_images.get(page_id, []))
+
+    # Legacy paths have no such guarantee, so each is stat'ed (concurrently); not remembered between queries,
+    # since files can be removed at any time and other workers would never hear about it
+    legacy_ids = [image_id for image_id in dict.fromkeys(os.path.basename(p) for p in candidate_image_paths)
+                  if image_id not in image_ids]
+    if legacy_ids:
+        path_exists = await asyncio.gather(
+            *[asyncio.to_thread(os.path.exists, _resolve_image_path(image_id)) for image_id in legacy_ids]
+        )
+        image_ids.update((image_id, None) for image_id, exists in zip(legacy_ids, path_exists) if exists)
+    return list(image_ids)
+
+async def _stream_cached(result: dict):
+    yield _sse({"token": result["answer"]})
+    yield _sse({"done": True, "image_ids": result["image_ids"]})
+
+# --- End Query Helpers ---
+
+
 # --- API Endpoints ---
-# (Keep /upload, /list_collections, /create_collection, /delete_collection as they are)
+# (Keep /list_collections, /create_collection, /delete_collection as they are)
 @app.post("/upload/")
 async def upload_pdf_endpoint(
     collection_name: str = Form(...),
@@ -70,17 +247,60 @@ async def upload_pdf_endpoint(
 ):
     if not file.content_type or "pdf" not in file.content_type.lower():
         raise HTTPException(status_code=400, detail="Only PDF files allowed.")
-    contents = await file.read()
-    return uploader.upload(contents, file.filename, collection_name)
+    # Copied in 1 MiB pieces straight into the file the job parses, hashing on the way, so memory stays
+    # bounded and the bytes are written once. Writes and the SQLite insert run on threads to keep the event
+    # loop free. The job deletes the file when it finishes; until it is submitted, this endpoint does.
+    tmp = tempfile.NamedTemporaryFile(suffix=".pdf", delete=False)
+    hasher = file_hasher()
+    try:
+        with tmp:
+            while chunk := await file.read(1 << 20):
+                await asyncio.to_thread(_write_upload_chunk, tmp, hasher, chunk)
+
+        job_id = uuid.uuid4().hex
+        await asyncio.to_thread(job_store.create, job_id, file_name=file.filename, collection_name=collection_name)
+        upload_executor.submit(_run_upload_job, job_id, tmp.name, hasher.hexdigest(), file.filename, collection_name)
+    except BaseException:
+        os.remove(tmp.name)
+        raise
+    return {"job_id": job_id, "status": "queued"}
+
+@app.get("/jobs/{job_id}")
+def get_job_endpoint(job_id: str):
+    job = job_store.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job '{job_id}' not found.")
+    return job
+
+@app.get("/image/{image_id}")
+def get_image_endpoint(image_id: str):
+    # Only bare image file names inside IMAGE_DIR are served (no paths, no other files in that directory)
+    media_type, _ = mimetypes.guess_type(image_id)
+    if image_id != os.path.basename(image_id) or not media_type or not media_type.startswith("image/"):
+        raise HTTPException(status_code=400, detail="Invalid image id.")
+    image_path = os.path.join(IMAGE_DIR_ABS, image_id)
+    if not os.path.isfile(image_path):
+        raise HTTPException(status_code=404, detail=f"Image '{image_id}' not found.")
+    # Image ids are content digests, so a given id always names the same bytes
+    return FileResponse(image_path, media_type=media_type, headers={"Cache-Control": "public, max-age=31536000, immutable"})
+
+@app.post("/reconcile_images")
+def reconcile_images_endpoint():
+    """Removes page-store references to images that are no longer in IMAGE_DIR (e.g. deleted by hand)."""
+    with os.scandir(IMAGE_DIR_ABS) as entries:
+        present = {entry.name for entry in entries if entry.is_file()}
+    removed = page_store.remove_missing_images(lambda img_path: os.path.basename(img_path) in present)
+    # Cached answers in every worker may list the removed images
+    query_cache.invalidate_all()
+    logger.info("Reconciled page store: removed %d missing image references", removed)
+    return {"status": "reconciled", "images_removed": removed}
 
 @app.get("/list_collections")
 def list_collections_endpoint():
     try:
-        collections_response = qdrant.get_client().get_collections()
-        collection_names = [col.name for col in collections_response.collections]
-        return {"collections": collection_names}
+        return {"collections": qdrant.list_collections()}
     except Exception as e:
-        print(f"Error listing collections: {e}")
+        logger.warning("Error listing collections: %s", e)
         if "connection refused" in str(e).lower() or "failed to connect" in str(e).lower():
              raise HTTPException(status_code=503, detail=f"Could not connect to Qdrant at {QDRANT_URL}. Is it running?")
         return {"collections": []}
@@ -88,7 +308,10 @@ def list_collections_endpoint():
 @app.post("/create_collection")
 def create_collection_endpoint(payload: CollectionNamePayload):
     try:
-        qdrant.ensure_collection(payload.collection_name)
+        if qdrant.ensure_collection(payload.collection_name, use_cache=False):
+            # Recreated under an old name: forget what was ingested into the previous collection
+            page_store.delete_collection(payload.collection_name)
+            query_cache.invalidate_collection(payload.collection_name)
         return {"status": "created", "collection_name": payload.collection_name}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to create collection: {str(e)}")
@@ -96,7 +319,9 @@ def create_collection_endpoint(payload: CollectionNamePayload):
 @app.delete("/delete_collection")
 def delete_collection_endpoint(payload: CollectionNamePayload):
     try:
-        qdrant.get_client().delete_collection(collection_name=payload.collection_name)
+        qdrant.delete_collection(payload.collection_name)
+        page_store.delete_collection(payload.collection_name)
+        query_cache.invalidate_collection(payload.collection_name)
         return {"status": "deleted", "collection_name": payload.collection_name}
     except Exception as e:
         error_message = str(e)
@@ -118,39 +343,52 @@ async def query_endpoint(payload: QueryPayload):
     try:
         query_text = payload.query
         collection_name = payload.collection_name
-        print(f"Received query for collection '{collection_name}': {query_text}")
+        logger.info("Received query for collection '%s'", collection_name)
+        logger.debug("Query text: %s", query_text)
+
+        cache_generation = await asyncio.to_thread(query_cache.generation, collection_name)
+        cached_result = query_cache.get(collection_name, query_text, cache_generation)
+        if cached_result is not None:
+            logger.debug("Returning cached answer.")
+            return StreamingResponse(_stream_cached(cached_result), media_type="text/event-stream")
 
-        # 1. Embed the query
-        query_vector = embedder.embed(query_text)
+        # 1. Embed the query (float32 array, sent to Qdrant as packed floats over gRPC)
+        query_vector = await embedder.aembed(query_text)
 
         # 2. Search Qdrant
         try:
-            search_result = qdrant.get_client().query_points(
+            search_result = await qdrant.get_async_client().query_points(
                 collection_name=collection_name,
                 query=query_vector,
                 limit=5,
-                with_payload=True,
-                with_vectors=False
+                score_threshold=CONTEXT_SCORE_THRESHOLD,
+                # Only the fields read below; source/file_hash/page_number etc. stay in Qdrant
+                with_payload=models.PayloadSelectorInclude(include=QUERY_PAYLOAD_FIELDS),
+                with_vectors=False,
+                # Ignored by collections without quantization
+                search_params=models.SearchParams(
+                    quantization=models.QuantizationSearchParams(rescore=True, oversampling=QUANTIZATION_OVERSAMPLING)
+                ),
             )
         except Exception as qdrant_error:
-            print(f"!!! Qdrant query_points failed: {qdrant_error}")
-            traceback.print_exc()
+            logger.exception("Qdrant query_points failed")
             raise HTTPException(status_code=503, detail=f"Failed to query Qdrant: {qdrant_error}")
 
         # Check results structure
         num_results = 0
         if hasattr(search_result, 'points'):
             num_results = len(search_result.points)
-            print(f"Qdrant search returned QueryResponse with {num_results} results.")
+            logger.debug("Qdrant search returned QueryResponse with %d results.", num_results)
         elif isinstance(search_result, list):
             num_results = len(search_result)
-            print(f"Qdrant search returned a direct list with {num_results} results.")
+            logger.debug("Qdrant search returned a direct list with %d results.", num_results)
         else:
-            print(f"Qdrant search returned unexpected type: {type(search_result)}")
+            logger.warning("Qdrant search returned unexpected type: %s", type(search_result))
 
         # 3. Process results for context and images, applying threshold for images
         context_texts = []
-        retrieved_image_paths = set()
+        image_page_ids = [] # Pages whose images are wanted, looked up once per unique page below
+        candidate_image_paths = []
 
         hits = []
         if hasattr(search_result, 'points'):
@@ -158,12 +396,11 @@ async def query_endpoint(payload: QueryPayload):
         elif isinstance(search_result, list):
             hits = search_result
 
-        print(f"Applying image relevance threshold: {SCORE_THRESHOLD}")
         for hit in hits:
             try:
                 payload_data = hit.payload
                 score = hit.score
-                print(f"  - Processing Hit ID: {hit.id}, Score: {score:.4f}")
+                logger.debug("Hit %s, score %.4f (image threshold %s)", hit.id, score, SCORE_THRESHOLD)
 
                 if payload_data:
                     chunk_text = payload_data.get("text")
@@ -171,84 +408,81 @@ async def query_endpoint(payload: QueryPayload):
                         context_texts.append(chunk_text)
 
                     if score >= SCORE_THRESHOLD:
-                        print(f"    - Score meets threshold, processing images for this chunk.")
-                        image_paths_json = payload_data.get("associated_image_paths", "[]")
-                        try:
-                            image_paths = json.loads(image_paths_json)
-                            for img_path in image_paths:
-                                potential_path = img_path
-                                if not os.path.isabs(img_path) and not img_path.startswith(IMAGE_DIR):
-                                     potential_path = os.path.join(IMAGE_DIR, os.path.basename(img_path))
-                                if os.path.exists(potential_path):
-                                     retrieved_image_paths.add(potential_path)
-                        except json.JSONDecodeError:
-                            print(f"    - Warning: Could not decode image paths JSON: {image_paths_json}")
-                    else:
-                         print(f"    - Score below threshold, skipping images for this chunk.")
+                        page_id = payload_data.get("page_id")
+                        if page_id is not None:
+                            if page_id not in image_page_ids:
+                                image_page_ids.append(page_id)
+                        else:
+                            # Points ingested before page_id existed carry their image paths inline,
+                            # either as a native list or (oldest) as a JSON-encoded string
+                            image_paths = payload_data.get("associated_image_paths") or []
+                            if isinstance(image_paths, str):
+                                try:
+                                    image_paths = orjson.loads(image_paths)
+                                except orjson.JSONDecodeError:
+                                    logger.warning("Could not decode image paths JSON: %s", image_paths)
+                                    image_paths = []
+                            candidate_image_paths.extend(image_paths)
                 else:
-                    print(f"  - Warning: Hit ID {hit.id} has no payload.")
+                    logger.warning("Hit %s has no payload.", hit.id)
             except AttributeError as ae:
-                 print(f"  - Error processing hit: {ae}. Hit details: {hit}")
+                 logger.warning("Error processing hit: %s. Hit details: %s", ae, hit)
                  continue
 
-        # 4. Generate Augmented Answer using LLM (if context found)
-        final_answer = "No relevant information found in the documents." # Default
-
-        if context_texts:
-            print("Context found, invoking LLM for augmentation...")
-            combined_context = "\n\n---\n\n".join(context_texts)
-            prompt = f"""Based *only* on the following context retrieved from documents, please provide a concise answer to the user's question. Do not use any prior knowledge. If the context does not contain the answer, say so.
-
-            Context:
-            {combined_context}
+        # 4. Image IDs (only images that met the threshold); the client fetches the bytes from /image/{id}.
+        # Resolved in the background so the lookups overlap with LLM generation instead of delaying it.
+        image_ids_task = asyncio.create_task(_find_image_ids(collection_name, image_page_ids, candidate_image_paths))
 
-            ---
-            User Question: {query_text}
-            ---
+        if not context_texts:
+            logger.info("No relevant text context found in Qdrant results.")
+            result = {"answer": DEFAULT_NO_CTX, "image_ids": await image_ids_task}
+            query_cache.set(collection_name, query_text, result, cache_generation)
+            return StreamingResponse(_stream_cached(result), media_type="text/event-stream")
 
-            Answer:"""
+        # 5. Generate Augmented Answer using LLM, streamed to the client token by token
+        combined_context = "\n\n---\n\n".join(context_texts)
+        prompt = PROMPT_TMPL.format(context=combined_context, question=query_text)
 
-            # --- Correctly indented try/except INSIDE 'if context_texts:' ---
+        async def generate():
+            answer_parts = []
+            answer_is_cacheable = True
             try:
-                print("Sending prompt to LLM...")
-                # Use the 'llm' instance initialized earlier
-                llm_response = llm.invoke(prompt)
-                print("LLM response received.")
-                final_answer = llm_response.strip() # Overwrite default answer
+                # Held for the whole generation, since that is how long Ollama is busy with it
+                async with llm_semaphore:
+                    async for token in llm.astream(prompt, system=SYSTEM_PROMPT):
+                        if not answer_parts:
+                            token = token.lstrip() # Same as the old .strip() on the full answer
+                            if not token:
+                                continue
+                        answer_parts.append(token)
+                        yield _sse({"token": token})
             except Exception as e:
-                print(f"!!! ERROR invoking LLM: {e} !!!")
-                # Fallback answer if LLM fails
-                final_answer = "Error generating answer from context. Using raw context instead.\n\n" + combined_context
-            # --- End of correctly indented try/except ---
-
-        else: # This else corresponds to 'if context_texts:'
-             print("No relevant text context found in Qdrant results.")
-             # final_answer remains the default "No relevant information..."
-
-        # 5. Load and encode images (only those that met the threshold)
-        # --- Correctly indented block, aligned with Step 4 start ---
-        encoded_images: List[str] = []
-        print(f"Attempting to load {len(retrieved_image_paths)} unique image paths that met the score threshold...")
-        for img_path in retrieved_image_paths:
+                logger.error("Error invoking LLM: %s", e)
+                # Fallback answer if LLM fails (appended to whatever was already streamed)
+                fallback = LLM_ERROR_PREFIX + combined_context
+                answer_parts.append(fallback)
+                yield _sse({"token": fallback})
+                answer_is_cacheable = False # Don't pin a transient LLM failure for the whole TTL
+
             try:
-                if os.path.exists(img_path):
-                    with open(img_path, "rb") as image_file:
-                        image_data = image_file.read()
-                        encoded_string = base64.b64encode(image_data).decode('utf-8')
-                        encoded_images.append(encoded_string)
-                else:
-                     print(f"Warning: Image file not found at final path check: {img_path}")
+                image_ids = await image_ids_task
             except Exception as e:
-                print(f"Error reading or encoding image {img_path}: {e}")
-        # --- End of correctly indented block ---
-
-        print(f"Returning answer and {len(encoded_images)} images.")
-        return {"answer": final_answer, "images": encoded_images}
+                logger.error("Error resolving images: %s", e)
+                image_ids = []
+                answer_is_cacheable = False
+            logger.info("Answered query with %d image IDs.", len(image_ids))
+            if answer_is_cacheable:
+                query_cache.set(
+                    collection_name, query_text,
+                    {"answer": "".join(answer_parts).rstrip(), "image_ids": image_ids}, cache_generation,
+                )
+            yield _sse({"done": True, "image_ids": image_ids})
+
+        return StreamingResponse(generate(), media_type="text/event-stream")
 
     # This except corresponds to the main 'try' at the start of the function
     except Exception as e:
-        print(f"Error during query processing: {e}")
-        traceback.print_exc()
+        logger.exception("Error during query processing")
         raise HTTPException(status_code=500, detail=f"Query processing failed: {str(e)}")
 
 # Rest of the file should be okay if it followed standard Python indentation
@@ -258,10 +492,12 @@ if __name__ == "__main__":
     print("Starting FastAPI server...")
     print(f"Qdrant URL: {QDRANT_URL}")
     print(f"Ollama URL: {OLLAMA_URL}")
-    print(f"Embedding Model: {EMBED_MODEL} (Dim: {EMBEDDING_DIM})")
+    print(f"Embedding Model: {EMBED_MODEL} (Dim: {EMBEDDING_DIM}, Stored as: {VECTOR_DTYPE})")
     print(f"LLM Model for Augmentation: {LLM_MODEL}")
     print(f"Image Directory: {IMAGE_DIR}")
     print(f"Image Score Threshold: {SCORE_THRESHOLD}") # Print threshold at startup
-    if not llm:
-        print("WARNING: LLM failed to initialize. Query augmentation disabled.")
-    uvicorn.run(app, host="127.0.0.1", port=8000)
\ No newline at end of file
+    print(f"Context Score Threshold: {CONTEXT_SCORE_THRESHOLD}")
+    print(f"Server Workers: {SERVER_WORKERS}")
+    # Passed as an import string so each worker process imports the app (and runs lifespan) itself.
+    # "auto" picks uvloop and httptools when they are installed, and falls back to asyncio/h11 otherwise.
+    uvicorn.run("main:app", host="127.0.0.1", port=8000, workers=SERVER_WORKERS, loop="auto", http="auto")
\ No newline at end of file
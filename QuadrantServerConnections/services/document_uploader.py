@@ -1,54 +1,144 @@
 # services/document_uploader.py
-import io, os, json
-from qdrant_client.models import PointStruct
+import hashlib, logging, uuid
+import numpy as np
+from qdrant_client.models import Batch
+from tenacity import retry, stop_after_attempt, wait_exponential_jitter
+from services.qdrant_connector import is_not_found
+
+logger = logging.getLogger(__name__)
+
+EMBED_BATCH_SIZE = 64
+UPSERT_BATCH_SIZE = 128
+
+def file_hasher():
+    """The hash identifying an uploaded file's bytes (duplicate check, point IDs); fed chunk by chunk."""
+    return hashlib.blake2b(digest_size=32)
 
 class DocumentUploader:
-    def __init__(self, qdrant_connector, embedder, chunker, pdf_processor, default_collection):
+    def __init__(self, qdrant_connector, embedder, chunker, pdf_processor, page_store, default_collection,
+                 embed_batch_size: int = EMBED_BATCH_SIZE):
         self.qdrant = qdrant_connector
         self.embedder = embedder
         self.chunker = chunker
         self.pdf_processor = pdf_processor
+        self.page_store = page_store
         self.default_collection = default_collection
+        self.embed_batch_size = embed_batch_size
+
+    @retry(stop=stop_after_attempt(5), wait=wait_exponential_jitter(initial=0.5, max=8), reraise=True)
+    def _embed_with_retry(self, texts: list[str]):
+        vectors = self.embedder.embed_batch(texts)
+        if len(vectors) != len(texts):
+            raise ValueError(f"Embedder returned {len(vectors)} vectors for {len(texts)} texts")
+        return vectors
 
-    def upload(self, file_bytes: bytes, file_name: str, collection_name: str = None):
+    def _valid_rows(self, vectors: np.ndarray) -> np.ndarray:
+        """Boolean mask of rows with the collection's dimension and no NaN/Inf values."""
+        if vectors.ndim != 2 or vectors.shape[1] != self.qdrant.vector_size:
+            return np.zeros(len(vectors), dtype=bool)
+        return np.isfinite(vectors).all(axis=1)
+
+    def upload(self, pdf_path: str, file_hash: str, file_name: str, collection_name: str = None):
+        """Ingests the PDF at pdf_path, whose file_hasher() digest is file_hash. The caller owns the file."""
         collection = collection_name or self.default_collection
+        if self.qdrant.ensure_collection(collection):
+            # New (or recreated) collection: markers and page images from a previous one are stale
+            self.page_store.delete_collection(collection)
+
+        # MuPDF reads pages lazily from the file, so the PDF is never held in memory as a whole
+        try:
+            return self._ingest(pdf_path, file_hash, file_name, collection)
+        except Exception as e:
+            if not is_not_found(e):
+                raise
+            # Collection deleted (by another worker) while still cached as ensured here. The delete was
+            # deliberate, so fail the job instead of silently recreating the collection.
+            self.qdrant.invalidate_metadata(collection)
+            raise RuntimeError(f"Collection '{collection}' was deleted during the upload of {file_name}") from e
+
+    def _ingest(self, pdf_path: str, file_hash: str, file_name: str, collection: str):
         client = self.qdrant.get_client()
-        self.qdrant.ensure_collection(collection)
 
-        doc = self.pdf_processor.parse_pdf(file_bytes, file_name)
-        base_name = os.path.splitext(file_name)[0]
-        total_chunks, total_images = 0, 0
-        points = []
+        # Identical bytes already fully indexed in this collection: skip parsing and embedding entirely.
+        # Only a completed ingest (no failed chunks) is recorded, so partial or in-progress uploads are
+        # re-ingested; the deterministic point IDs make that overwrite rather than duplicate.
+        doc_id = file_hash[:16]
+        ingested = self.page_store.get_ingested(collection, file_hash)
+        if ingested:
+            return {"message": f"{file_name} already processed", **ingested, "duplicate": True}
 
-        for page_num, page in enumerate(doc):
-            images = self.pdf_processor.extract_images_from_page(doc, page, base_name, page_num)
+        total_chunks, total_images, failed_chunks = 0, 0, 0
+        pending = []  # (page_payload_template, point_id, chunk_text) for every chunk in the document
+        page_images = {}  # page_id -> image paths, stored once per page in the page store
+        # Structure-of-arrays buffer for the next upsert: parallel id / vector / payload columns
+        ids, vector_rows, payloads = [], [], []
+
+        def _flush(count: int, wait: bool):
+            client.upsert(
+                collection_name=collection,
+                points=Batch(ids=ids[:count], vectors=np.stack(vector_rows[:count]).tolist(), payloads=payloads[:count]),
+                wait=wait,
+            )
+            del ids[:count], vector_rows[:count], payloads[:count]
+
+        # Single layout pass per page; pages arrive in order
+        for page_num, text, images in self.pdf_processor.iter_pages(pdf_path):
+            page_id = f"{doc_id}:{page_num}"
             total_images += len(images)
-            image_meta = json.dumps(images)
-
-            text = page.get_text("text", sort=True)
-            if not text.strip(): continue
-            chunks = self.chunker.chunk(text)
-
-            for chunk in chunks:
-                try:
-                    vector = self.embedder.embed(chunk.page_content)
-                    payload = {
-                        "source": file_name,
-                        "page_number": page_num,
-                        "chunk_index": total_chunks,
-                        "text": chunk.page_content,
-                        "associated_image_paths": image_meta,
-                    }
-                    points.append(PointStruct(id=total_chunks + 1, vector=vector, payload=payload))
-                    total_chunks += 1
-                except Exception as e:
-                    print(f"Embedding failed: {e}")
-
-        if points:
-            client.upsert(collection_name=collection, points=points, wait=True)
+            if images:
+                page_images[page_id] = images
+            # Fields shared by every chunk of the page, built once and reused
+            page_payload_template = {
+                "source": file_name,
+                "page_number": page_num,
+                "page_id": page_id,
+                "file_hash": file_hash,
+            }
+            texts = self.chunker.chunk(text) if text.strip() else []
+            for chunk_in_page, chunk_text in enumerate(texts):
+                # Same document + page + position always maps to the same ID, so retries and
+                # concurrent uploads overwrite their own points instead of colliding
+                point_id = str(uuid.uuid5(uuid.NAMESPACE_URL, f"{doc_id}:{page_num}:{chunk_in_page}"))
+                pending.append((page_payload_template, point_id, chunk_text))
+
+        # Saved before any point is upserted so a search never sees a page_id without its images
+        self.page_store.save_pages(collection, page_images)
+
+        # Embed in batches so each Ollama round-trip covers many chunks
+        for start in range(0, len(pending), self.embed_batch_size):
+            batch = pending[start:start + self.embed_batch_size]
+            try:
+                vectors = self._embed_with_retry([text for _, _, text in batch])
+            except Exception:
+                logger.exception("Embedding failed for chunks %d-%d of %s after retries", start, start + len(batch) - 1, file_name)
+                failed_chunks += len(batch)
+                continue
+
+            valid_rows = self._valid_rows(vectors)
+            for (page_payload_template, point_id, text), vector, is_valid in zip(batch, vectors, valid_rows):
+                if not is_valid:
+                    logger.warning("Dropping chunk on page %d of %s: embedding has wrong dimension or NaN/Inf values", page_payload_template["page_number"], file_name)
+                    failed_chunks += 1
+                    continue
+                ids.append(point_id)
+                vector_rows.append(vector)
+                payloads.append({**page_payload_template, "chunk_index": total_chunks, "text": text})
+                total_chunks += 1
+
+            # Stream full batches to Qdrant without waiting so memory stays bounded by the batch size;
+            # at least one point is always held back for the final, waited flush
+            while len(ids) > UPSERT_BATCH_SIZE:
+                _flush(UPSERT_BATCH_SIZE, wait=False)
+
+        # Final flush waits so the document is searchable once upload() returns
+        if ids:
+            _flush(len(ids), wait=True)
+        if failed_chunks == 0:
+            self.page_store.mark_ingested(collection, file_hash, total_chunks, total_images)
 
         return {
             "message": f"{file_name} processed",
             "chunks_stored": total_chunks,
-            "images_stored": total_images
+            "images_stored": total_images,
+            "chunks_failed": failed_chunks,
         }
@@ -1,9 +1,99 @@
 # services/embedder.py
-from langchain_ollama import OllamaEmbeddings
+import threading
+from collections import OrderedDict
+import httpx
+import numpy as np
+import orjson
+
+# Query vectors shared by every Embedder in the process, keyed by (model, text).
+# Module-level so cache keys don't depend on Embedder instances (which aren't hashable).
+QUERY_CACHE_SIZE = 2048
+_query_cache: OrderedDict[tuple[str, str], np.ndarray] = OrderedDict()
+_query_cache_lock = threading.Lock()
+
+def _cache_get(key: tuple[str, str]):
+    with _query_cache_lock:
+        vector = _query_cache.get(key)
+        if vector is not None:
+            _query_cache.move_to_end(key)
+        return vector
+
+def _cache_put(key: tuple[str, str], vector):
+    with _query_cache_lock:
+        _query_cache[key] = vector
+        _query_cache.move_to_end(key)
+        if len(_query_cache) > QUERY_CACHE_SIZE:
+            _query_cache.popitem(last=False)
 
 class Embedder:
-    def __init__(self, model: str, base_url: str):
-        self.embedding_model = OllamaEmbeddings(model=model, base_url=base_url)
+    """Embeds text with Ollama's batch endpoint (POST /api/embed, {"model", "input": [...]}).
+
+    One request covers a whole list of texts; pooled httpx clients keep the connection to Ollama alive.
+    """
+
+    def __init__(self, model: str, base_url: str, num_gpu: int | None = None, keep_alive: int | None = None,
+                 client_kwargs: dict | None = None, timeout: float = 120.0,
+                 async_client: httpx.AsyncClient | None = None):
+        self.model = model
+        self.embed_url = base_url.rstrip("/") + "/api/embed"
+        # Inference runs on the Ollama server: num_gpu sets how many layers it offloads to the GPU,
+        # keep_alive (seconds) keeps the model resident between batches instead of reloading it
+        self.options = {"num_gpu": num_gpu} if num_gpu is not None else {}
+        self.keep_alive = keep_alive
+        client_kwargs = {"timeout": timeout, **(client_kwargs or {})}
+        self.client = httpx.Client(**client_kwargs)
+        # A shared async client (e.g. one per server worker) is used as-is and left for its owner to close
+        self._owns_aclient = async_client is None
+        self.aclient = async_client or httpx.AsyncClient(**client_kwargs)
+
+    def _request_body(self, texts: list[str]) -> dict:
+        body = {"model": self.model, "input": texts}
+        if self.options:
+            body["options"] = self.options
+        if self.keep_alive is not None:
+            body["keep_alive"] = self.keep_alive
+        return body
+
+    @staticmethod
+    def _parse_embeddings(response: httpx.Response) -> np.ndarray:
+        response.raise_for_status()
+        return np.asarray(orjson.loads(response.content)["embeddings"], dtype=np.float32)
+
+    @staticmethod
+    def _as_query_vector(vector) -> np.ndarray:
+        # Cast once to float32 (what Qdrant stores); read-only because cached arrays are shared by callers
+        vector = np.asarray(vector, dtype=np.float32)
+        vector.flags.writeable = False
+        return vector
+
+    def embed(self, text: str) -> np.ndarray:
+        key = (self.model, text)
+        cached = _cache_get(key)
+        if cached is None:
+            cached = self._as_query_vector(self.embed_batch([text])[0])
+            _cache_put(key, cached)
+        return cached
+
+    async def aembed(self, text: str) -> np.ndarray:
+        key = (self.model, text)
+        cached = _cache_get(key)
+        if cached is None:
+            response = await self.aclient.post(self.embed_url, content=orjson.dumps(self._request_body([text])),
+                                               headers={"Content-Type": "application/json"})
+            cached = self._as_query_vector(self._parse_embeddings(response)[0])
+            _cache_put(key, cached)
+        return cached
+
+    def embed_batch(self, texts: list[str]) -> np.ndarray:
+        # One round-trip to Ollama for the whole batch instead of one per text;
+        # returned as a (len(texts), dim) float32 array rather than nested Python float lists
+        response = self.client.post(self.embed_url, content=orjson.dumps(self._request_body(texts)),
+                                    headers={"Content-Type": "application/json"})
+        return self._parse_embeddings(response)
+
+    def close(self):
+        self.client.close()
 
-    def embed(self, text: str):
-        return self.embedding_model.embed_query(text)
+    async def aclose(self):
+        if self._owns_aclient:
+            await self.aclient.aclose()
@@ -0,0 +1,63 @@
+# services/job_store.py
+import time
+import orjson
+from services.sqlite_db import connect
+
+class JobStore:
+    """Upload job status shared by every server worker process.
+
+    A job is polled through /jobs/{job_id}, which may land on a different worker than the
+    one running the upload, so the state can't live in a per-process dict.
+    A queued or running job not finished within stale_seconds (of being queued or started) is reported
+    as failed, since the worker that owned it has most likely died.
+    """
+
+    def __init__(self, db_path: str, retention_seconds: int = 3600, stale_seconds: int = 7200):
+        self.db_path = db_path
+        self.retention_seconds = retention_seconds
+        self.stale_seconds = stale_seconds
+        with connect(self.db_path) as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS upload_jobs ("
+                " job_id TEXT PRIMARY KEY,"
+                " data TEXT NOT NULL,"
+                " finished_at REAL)"
+            )
+
+    def create(self, job_id: str, **fields):
+        """Registers a queued job, forgetting finished jobs older than retention_seconds."""
+        job = {"job_id": job_id, "status": "queued", "created_at": time.time(), **fields}
+        with connect(self.db_path) as conn:
+            conn.execute(
+                "DELETE FROM upload_jobs WHERE finished_at IS NOT NULL AND finished_at < ?",
+                (time.time() - self.retention_seconds,),
+            )
+            conn.execute(
+                "INSERT INTO upload_jobs (job_id, data) VALUES (?, ?)",
+                (job_id, orjson.dumps(job).decode("utf-8")),
+            )
+
+    def update(self, job_id: str, **fields):
+        with connect(self.db_path) as conn:
+            row = conn.execute("SELECT data FROM upload_jobs WHERE job_id = ?", (job_id,)).fetchone()
+            if row is None:
+                return
+            job = {**orjson.loads(row[0]), **fields}
+            conn.execute(
+                "UPDATE upload_jobs SET data = ?, finished_at = ? WHERE job_id = ?",
+                (orjson.dumps(job).decode("utf-8"), job.get("finished_at"), job_id),
+            )
+
+    def get(self, job_id: str) -> dict | None:
+        with connect(self.db_path) as conn:
+            row = conn.execute("SELECT data FROM upload_jobs WHERE job_id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = orjson.loads(row[0])
+        if job["status"] in ("queued", "running"):
+            since = job.get("started_at") or job.get("created_at", 0)
+            if time.time() - since > self.stale_seconds:
+                error = f"Job was {job['status']} for over {self.stale_seconds}s; the worker stopped or timed out"
+                self.update(job_id, status="failed", error=error, finished_at=time.time())
+                job = {**job, "status": "failed", "error": error}
+        return job
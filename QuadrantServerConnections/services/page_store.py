@@ -0,0 +1,96 @@
+# services/page_store.py
+from typing import Callable
+import orjson
+from services.sqlite_db import connect
+
+class PageImageStore:
+    """Keeps the extracted image paths of each page once, keyed by (collection, page_id).
+
+    Chunks only carry a small `page_id` in their Qdrant payload instead of repeating the
+    page's image list in every chunk. Also records which files finished ingesting, per collection.
+    """
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        with connect(self.db_path) as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS page_images ("
+                " collection TEXT NOT NULL,"
+                " page_id TEXT NOT NULL,"
+                " image_paths TEXT NOT NULL,"
+                " PRIMARY KEY (collection, page_id))"
+            )
+            # One row per file fully ingested into a collection (written only when no chunk failed)
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS ingested_files ("
+                " collection TEXT NOT NULL,"
+                " file_hash TEXT NOT NULL,"
+                " chunks_stored INTEGER NOT NULL,"
+                " images_stored INTEGER NOT NULL,"
+                " PRIMARY KEY (collection, file_hash))"
+            )
+
+    def save_pages(self, collection: str, page_images: dict[str, list[str]]):
+        if not page_images:
+            return
+        rows = [(collection, page_id, orjson.dumps(paths).decode("utf-8")) for page_id, paths in page_images.items()]
+        with connect(self.db_path) as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO page_images (collection, page_id, image_paths) VALUES (?, ?, ?)",
+                rows,
+            )
+
+    def get_images(self, collection: str, page_ids: list[str]) -> dict[str, list[str]]:
+        if not page_ids:
+            return {}
+        placeholders = ",".join("?" * len(page_ids))
+        with connect(self.db_path) as conn:
+            rows = conn.execute(
+                f"SELECT page_id, image_paths FROM page_images WHERE collection = ? AND page_id IN ({placeholders})",
+                [collection, *page_ids],
+            ).fetchall()
+        return {page_id: orjson.loads(paths) for page_id, paths in rows}
+
+    def mark_ingested(self, collection: str, file_hash: str, chunks_stored: int, images_stored: int):
+        with connect(self.db_path) as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO ingested_files (collection, file_hash, chunks_stored, images_stored)"
+                " VALUES (?, ?, ?, ?)",
+                (collection, file_hash, chunks_stored, images_stored),
+            )
+
+    def get_ingested(self, collection: str, file_hash: str) -> dict | None:
+        """The stored counts of a completed ingest of this file, or None if it never completed."""
+        with connect(self.db_path) as conn:
+            row = conn.execute(
+                "SELECT chunks_stored, images_stored FROM ingested_files WHERE collection = ? AND file_hash = ?",
+                (collection, file_hash),
+            ).fetchone()
+        return {"chunks_stored": row[0], "images_stored": row[1]} if row else None
+
+    def delete_collection(self, collection: str):
+        with connect(self.db_path) as conn:
+            conn.execute("DELETE FROM page_images WHERE collection = ?", (collection,))
+            conn.execute("DELETE FROM ingested_files WHERE collection = ?", (collection,))
+
+    def remove_missing_images(self, is_present: Callable[[str], bool]) -> int:
+        """Drops image paths for which is_present(path) is False; pages left without images are deleted.
+
+        Returns the number of paths removed.
+        """
+        with connect(self.db_path) as conn:
+            rows = conn.execute("SELECT collection, page_id, image_paths FROM page_images").fetchall()
+            updates, deletes, removed = [], [], 0
+            for collection, page_id, paths_json in rows:
+                paths = orjson.loads(paths_json)
+                kept = [path for path in paths if is_present(path)]
+                if len(kept) == len(paths):
+                    continue
+                removed += len(paths) - len(kept)
+                if kept:
+                    updates.append((orjson.dumps(kept).decode("utf-8"), collection, page_id))
+                else:
+                    deletes.append((collection, page_id))
+            conn.executemany("UPDATE page_images SET image_paths = ? WHERE collection = ? AND page_id = ?", updates)
+            conn.executemany("DELETE FROM page_images WHERE collection = ? AND page_id = ?", deletes)
+        return removed
@@ -1,26 +1,133 @@
 # services/pdf_processor.py
-import os, json
+import os, json, hashlib, multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 import fitz
 from PIL import Image
 
+# Dict output with images, minus ligature preservation (expanded ligatures embed better), plus
+# joining of words hyphenated across line breaks
+PAGE_TEXT_FLAGS = (fitz.TEXTFLAGS_DICT & ~fitz.TEXT_PRESERVE_LIGATURES) | fitz.TEXT_DEHYPHENATE
+# Below this many pages, starting worker processes costs more than it saves
+PARALLEL_MIN_PAGES = 16
+
+def _extract_page_range(image_dir: str, sort_text: bool, pdf_path: str, start: int, stop: int):
+    """Runs in a worker process, which opens its own copy of the PDF (MuPDF is single-threaded per process)."""
+    processor = PDFProcessor(image_dir, sort_text=sort_text)  # page_workers=1: no nested pool
+    with processor.parse_pdf(pdf_path) as doc:
+        return list(processor._iter_doc_pages(doc, range(start, stop), set()))
+
 class PDFProcessor:
-    def __init__(self, image_dir: str):
+    def __init__(self, image_dir: str, sort_text: bool = False, page_workers: int = 1):
         os.makedirs(image_dir, exist_ok=True)
         self.image_dir = image_dir
+        # Reading-order sorting costs an O(n log n) geometric pass per page; the chunker only needs
+        # the text, so it is off unless a layout needs it
+        self.sort_text = sort_text
+        # Processes used for large documents; the pool is started on first use and reused for every
+        # later upload, since each spawned process pays a full interpreter start and module import
+        self.page_workers = page_workers
+        self._executor = None
+
+    def _get_executor(self):
+        if self._executor is None:
+            # spawn, not fork: the server process runs gRPC/httpx threads that a forked child would inherit broken
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.page_workers, mp_context=multiprocessing.get_context("spawn")
+            )
+        return self._executor
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
+
+    def parse_page(self, page):
+        # One layout pass per page; text and images are both read from this dict
+        return page.get_text("dict", sort=self.sort_text, flags=PAGE_TEXT_FLAGS)
+
+    def extract_text(self, page_dict):
+        lines = []
+        for block in page_dict["blocks"]:
+            if block["type"] != 0: continue
+            for line in block["lines"]:
+                lines.append("".join(span["text"] for span in line["spans"]))
+        return "\n".join(lines)
+
+    def extract_images_from_page(self, page_dict, written_images: set | None = None):
+        """Writes the page's images to image_dir and returns their paths.
 
-    def extract_images_from_page(self, doc, page, file_base, page_num):
+        Files are named by a digest of their bytes, so an image repeated on many pages or across
+        documents (logos, headers) is stored once and every page points at the same file.
+        written_images (digests already handled) is shared across the pages a process extracts from one
+        document, so a repeat doesn't even need a stat.
+        """
         image_paths = []
-        for i, img in enumerate(page.get_images(full=True)):
-            xref = img[0]
-            base_image = doc.extract_image(xref)
-            if not base_image or not base_image.get("image"): continue
-            ext = base_image.get("ext", "png")
-            img_name = f"{file_base}_page{page_num}_img{i}.{ext}"
-            img_path = os.path.join(self.image_dir, img_name)
-            with open(img_path, "wb") as f: f.write(base_image["image"])
-            image_paths.append(img_path.replace("\\", "/"))
+        for block in page_dict["blocks"]:
+            if block["type"] != 1: continue
+            image_bytes = block.get("image")
+            if not image_bytes: continue
+            digest = hashlib.blake2b(image_bytes, digest_size=16).hexdigest()
+            img_path = os.path.join(self.image_dir, f"{digest}.{block.get('ext', 'png')}").replace("\\", "/")
+            if img_path in image_paths: continue
+
+            if written_images is not None:
+                if digest in written_images:
+                    image_paths.append(img_path)
+                    continue
+                written_images.add(digest)
+
+            if not os.path.exists(img_path):
+                # Written under a temporary name and renamed, so /image/{id} never serves a partial file
+                # (per process, since page-range workers may hit the same image at once)
+                tmp_path = f"{img_path}.{os.getpid()}.tmp"
+                with open(tmp_path, "wb") as f: f.write(image_bytes)
+                os.replace(tmp_path, img_path)
+            image_paths.append(img_path)
         return image_paths
 
-    def parse_pdf(self, file_bytes: bytes, filename: str):
-        doc = fitz.open(stream=file_bytes, filetype="pdf")
+    def parse_pdf(self, pdf_path: str):
+        doc = fitz.open(pdf_path, filetype="pdf")
         return doc
+
+    def _iter_doc_pages(self, doc, page_nums, written_images: set):
+        for page_num in page_nums:
+            page_dict = self.parse_page(doc[page_num])
+            images = self.extract_images_from_page(page_dict, written_images)
+            yield page_num, self.extract_text(page_dict), images
+
+    def iter_pages(self, pdf_path: str):
+        """Yields (page_num, text, image_paths) for every page, in page order.
+
+        Each page is laid out once (parse_page) and both its text and images are read from that pass.
+        MuPDF doesn't support use from several threads (and holds the GIL), so large documents are split
+        into contiguous page ranges handled by the page_workers processes, each opening the file itself;
+        small ones are read sequentially in this process.
+        """
+        doc = self.parse_pdf(pdf_path)
+        page_count = len(doc)
+        if self.page_workers <= 1 or page_count < PARALLEL_MIN_PAGES:
+            with doc:
+                yield from self._iter_doc_pages(doc, range(page_count), set())
+            return
+        doc.close()
+
+        workers = min(self.page_workers, page_count)
+        bounds = [page_count * i // workers for i in range(workers + 1)]
+        executor = self._get_executor()
+        futures = [
+            executor.submit(_extract_page_range, self.image_dir, self.sort_text, pdf_path, start, stop)
+            for start, stop in zip(bounds, bounds[1:])
+        ]
+        try:
+            # Ranges are consumed in order, so pages still arrive in page order
+            for future in futures:
+                yield from future.result()
+        except BrokenProcessPool:
+            # A page process died (e.g. MuPDF crashed on a malformed file); start a fresh pool next time
+            self._executor = None
+            raise
+        finally:
+            # Stops ranges not yet started if the consumer gave up early
+            for future in futures:
+                future.cancel()
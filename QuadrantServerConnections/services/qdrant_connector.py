@@ -1,23 +1,145 @@
 # services/qdrant_connector.py
-from qdrant_client import QdrantClient
+import threading, time
+import grpc
+from qdrant_client import QdrantClient, AsyncQdrantClient
 from qdrant_client.http import models as rest
+from qdrant_client.http.exceptions import UnexpectedResponse
+
+VECTOR_DTYPES = ("float32", "float16", "int8")
+PAYLOAD_INDEXES = [
+    ("source", rest.PayloadSchemaType.KEYWORD),
+    ("page_number", rest.PayloadSchemaType.INTEGER),
+    ("file_hash", rest.PayloadSchemaType.KEYWORD),
+]
+
+# How long a collection stays marked as ensured before ensure_collection asks Qdrant again
+METADATA_TTL_SECONDS = 30
+
+def is_not_found(exc: BaseException) -> bool:
+    """True if Qdrant rejected the call because the collection (or point) does not exist."""
+    if isinstance(exc, grpc.RpcError):
+        return exc.code() == grpc.StatusCode.NOT_FOUND
+    if isinstance(exc, UnexpectedResponse):
+        return exc.status_code == 404
+    return False
 
 class QdrantConnector:
-    def __init__(self, url: str, api_key: str | None = None, vector_size: int = 1024):
+    def __init__(self, url: str, api_key: str | None = None, vector_size: int = 1024, vector_dtype: str = "int8",
+                 grpc_port: int = 6334, metadata_ttl: float = METADATA_TTL_SECONDS):
+        if vector_dtype not in VECTOR_DTYPES:
+            raise ValueError(f"vector_dtype must be one of {VECTOR_DTYPES}, got '{vector_dtype}'")
         self.url = url
         self.api_key = api_key
         self.vector_size = vector_size
-        self.client = QdrantClient(url=url, api_key=api_key,prefer_grpc= True)
+        self.vector_dtype = vector_dtype
+        # Vectors travel as packed protobuf floats over gRPC instead of JSON number text over REST
+        self.client = QdrantClient(url=url, api_key=api_key, prefer_grpc=True, grpc_port=grpc_port, timeout=60)
+        # Same gRPC settings for async callers (e.g. FastAPI endpoints) so they don't block the event loop
+        self.aclient = AsyncQdrantClient(url=url, api_key=api_key, prefer_grpc=True, grpc_port=grpc_port, timeout=60)
+        # Per-process cache of collections already ensured; a collection deleted by another worker can
+        # still look ensured here for up to metadata_ttl, so callers must handle NOT_FOUND (see is_not_found)
+        self.metadata_ttl = metadata_ttl
+        self._metadata_lock = threading.Lock()
+        self._ensured = {}  # collection name -> expires_at
 
     def get_client(self):
         return self.client
 
-    def ensure_collection(self, collection_name: str):
+    def get_async_client(self):
+        return self.aclient
+
+    def _storage_config(self):
+        """Returns (vectors_config, quantization_config) for the configured vector_dtype."""
+        if self.vector_dtype == "float16":
+            vectors = rest.VectorParams(size=self.vector_size, distance=rest.Distance.COSINE, datatype=rest.Datatype.FLOAT16)
+            return vectors, None
+        if self.vector_dtype == "int8":
+            # Full-precision vectors go to disk (used only for rescoring); the int8 copy stays in RAM for search
+            vectors = rest.VectorParams(size=self.vector_size, distance=rest.Distance.COSINE, on_disk=True)
+            quantization = rest.ScalarQuantization(
+                scalar=rest.ScalarQuantizationConfig(type=rest.ScalarType.INT8, quantile=0.99, always_ram=True)
+            )
+            return vectors, quantization
+        return rest.VectorParams(size=self.vector_size, distance=rest.Distance.COSINE), None
+
+    def _upgrade_quantization(self, collection_name: str, quantization_config):
+        """Adds int8 quantization to a collection created before it was the default.
+
+        Qdrant builds the quantized copy from the stored vectors in the background, so nothing is re-uploaded.
+        """
+        if quantization_config is None:
+            return
+        info = self.client.get_collection(collection_name)
+        if info.config.quantization_config is not None:
+            return
+        self.client.update_collection(
+            collection_name=collection_name,
+            vectors_config={"": rest.VectorParamsDiff(on_disk=True)},
+            quantization_config=quantization_config,
+        )
+
+    def invalidate_metadata(self, collection_name: str | None = None):
+        with self._metadata_lock:
+            if collection_name is None:
+                self._ensured.clear()
+            else:
+                self._ensured.pop(collection_name, None)
+
+    def list_collections(self) -> list[str]:
+        # Not cached here: a per-process copy would disagree between workers after a create/delete.
+        # The Streamlit client already caches this list for its own reruns.
+        return [col.name for col in self.client.get_collections().collections]
+
+    def delete_collection(self, collection_name: str):
+        # Also drops the collection from the ensured cache, so the next ensure_collection recreates it
+        try:
+            self.client.delete_collection(collection_name=collection_name)
+        finally:
+            self.invalidate_metadata(collection_name)
+
+    def ensure_collection(self, collection_name: str, use_cache: bool = True) -> bool:
+        """Creates the collection if needed; returns True only if this call created it.
+
+        A freshly created collection is empty, so callers drop any local state (page images,
+        ingested-file markers) left over from an earlier collection with the same name.
+        """
+        # Every upload calls this; once a collection has been set up, skip the create/index round-trips for a while.
+        # The cache is per process, so a collection deleted elsewhere may still look ensured: explicit creates
+        # pass use_cache=False to always reach Qdrant.
+        if use_cache:
+            with self._metadata_lock:
+                if self._ensured.get(collection_name, 0) > time.monotonic():
+                    return False
+        created = self._ensure_collection(collection_name)
+        with self._metadata_lock:
+            self._ensured[collection_name] = time.monotonic() + self.metadata_ttl
+        return created
+
+    def _ensure_collection(self, collection_name: str) -> bool:
+        vectors_config, quantization_config = self._storage_config()
+        created = True
         try:
             self.client.create_collection(
                 collection_name=collection_name,
-                vectors_config=rest.VectorParams(size=self.vector_size, distance=rest.Distance.COSINE),
+                vectors_config=vectors_config,
+                quantization_config=quantization_config,
             )
         except Exception as e:
             if "already exists" not in str(e).lower():
                 raise
+            created = False
+            self._upgrade_quantization(collection_name, quantization_config)
+
+        # Filtered lookups (one document, one page, duplicate-file check) probe these instead of scanning.
+        # Runs on every call so collections created before an index was added still get it.
+        for field_name, field_schema in PAYLOAD_INDEXES:
+            try:
+                self.client.create_payload_index(
+                    collection_name=collection_name,
+                    field_name=field_name,
+                    field_schema=field_schema,
+                )
+            except Exception as e:
+                if "already exists" not in str(e).lower():
+                    raise
+        return created
@@ -0,0 +1,80 @@
+# services/query_cache.py
+import hashlib, threading, time
+from collections import OrderedDict
+from services.sqlite_db import connect
+
+class QueryCache:
+    """In-process TTL + LRU cache of /query results, keyed by (collection, query text).
+
+    Each server worker keeps its own entries, but validity is shared: every collection has a generation
+    counter in SQLite (db_path) that uploads and deletes bump, plus a global one for changes that touch
+    every collection. An entry is only served while the generation it was computed under is current, so
+    an upload handled by one worker invalidates the answers cached by all of them.
+    """
+
+    def __init__(self, db_path: str, ttl_seconds: int = 3600, max_entries: int = 128):
+        self.db_path = db_path
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._entries: OrderedDict[str, tuple[float, str, tuple, dict]] = OrderedDict()
+        self._lock = threading.Lock()  # Upload worker threads invalidate while requests read
+        with connect(self.db_path) as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS cache_generations ("
+                " collection TEXT PRIMARY KEY,"
+                " generation INTEGER NOT NULL)"
+            )
+
+    def _key(self, collection: str, query: str) -> str:
+        return hashlib.sha256(f"{collection}||{query.strip()}".encode("utf-8")).hexdigest()
+
+    def generation(self, collection: str) -> tuple:
+        """Current (global, collection) generation; read it before computing a result and pass it to get/set."""
+        with connect(self.db_path) as conn:
+            rows = dict(conn.execute(
+                "SELECT collection, generation FROM cache_generations WHERE collection IN ('', ?)", (collection,)
+            ).fetchall())
+        return rows.get("", 0), rows.get(collection, 0)
+
+    def _bump(self, collection: str):
+        with connect(self.db_path) as conn:
+            conn.execute(
+                "INSERT INTO cache_generations (collection, generation) VALUES (?, 1)"
+                " ON CONFLICT(collection) DO UPDATE SET generation = generation + 1",
+                (collection,),
+            )
+
+    def get(self, collection: str, query: str, generation: tuple):
+        key = self._key(collection, query)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, _, entry_generation, result = entry
+            if expires_at < time.monotonic() or entry_generation != generation:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return result
+
+    def set(self, collection: str, query: str, result: dict, generation: tuple):
+        if self.max_entries <= 0:
+            return
+        key = self._key(collection, query)
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl_seconds, collection, generation, result)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate_collection(self, collection: str):
+        self._bump(collection)
+        with self._lock:
+            stale = [key for key, (_, entry_collection, _, _) in self._entries.items() if entry_collection == collection]
+            for key in stale:
+                del self._entries[key]
+
+    def invalidate_all(self):
+        self._bump("")
+        with self._lock:
+            self._entries.clear()
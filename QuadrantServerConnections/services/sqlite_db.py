@@ -0,0 +1,17 @@
+# services/sqlite_db.py
+import sqlite3
+from contextlib import contextmanager
+
+@contextmanager
+def connect(db_path: str):
+    """A short-lived connection: committed if the block succeeds, rolled back if it raises, always closed.
+
+    The stores open one per call rather than holding one, since sqlite3 connections can't be shared
+    between the event loop, to_thread calls and upload jobs.
+    """
+    conn = sqlite3.connect(db_path, timeout=30)
+    try:
+        with conn:
+            yield conn
+    finally:
+        conn.close()
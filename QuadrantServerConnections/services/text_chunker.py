@@ -1,11 +1,54 @@
 # services/text_chunker.py
-from langchain_text_splitters import RecursiveCharacterTextSplitter
+import re
+from bisect import bisect_left, bisect_right
+
+# Cut points, strongest first: paragraph break, line break, end of sentence/clause, word boundary.
+# The group number that matched is the cut's priority (lower is better).
+_SEPARATORS = re.compile(r"(\n\n)|(\n)|([.?!;] )|( )")
 
 class TextChunker:
     def __init__(self, chunk_size=1000, chunk_overlap=200):
-        self.splitter = RecursiveCharacterTextSplitter(
-            chunk_size=chunk_size, chunk_overlap=chunk_overlap, add_start_index=True
-        )
+        if chunk_overlap >= chunk_size:
+            raise ValueError("chunk_overlap must be smaller than chunk_size")
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+
+    def chunk(self, text: str) -> list[str]:
+        """Splits text into chunks of at most chunk_size characters, overlapping by up to chunk_overlap.
+
+        One regex pass collects every cut point; each chunk then ends at the strongest cut in the back
+        half of its window (falling back to a hard cut for unbroken runs of text).
+        """
+        cuts, priorities = [], []
+        for match in _SEPARATORS.finditer(text):
+            cuts.append(match.end())
+            priorities.append(match.lastindex)
+
+        chunks = []
+        start, length = 0, len(text)
+        while start < length:
+            limit = start + self.chunk_size
+            if limit >= length:
+                end = length
+            else:
+                lo = bisect_right(cuts, start + self.chunk_size // 2)
+                hi = bisect_right(cuts, limit)
+                if lo >= hi:
+                    lo = bisect_right(cuts, start)
+                end = limit
+                best = None
+                for i in range(lo, hi):
+                    if best is None or priorities[i] <= best:
+                        best, end = priorities[i], cuts[i]
+
+            piece = text[start:end].strip()
+            if piece:
+                chunks.append(piece)
+            if end >= length:
+                break
 
-    def chunk(self, text: str):
-        return self.splitter.create_documents([text])
+            # Next chunk starts at the first cut inside the overlap window so it doesn't begin mid-word
+            i = bisect_left(cuts, end - self.chunk_overlap)
+            next_start = cuts[i] if i < len(cuts) and cuts[i] < end else end
+            start = next_start if next_start > start else end
+        return chunks
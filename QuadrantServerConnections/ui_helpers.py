@@ -0,0 +1,21 @@
+# ui_helpers.py
+import streamlit as st
+from client import list_collections, clear_collections_cache
+
+def init_session_state():
+    """One-time checks for a new browser session. Call after st.set_page_config."""
+    if 'collections_checked' not in st.session_state:
+        st.session_state.collections_checked = True
+        # list_collections() is cached (ttl=30s) in client.py, so this is shared with the rest of the rerun
+        if not list_collections():
+            st.toast("Attempted to load collections: None found or backend connection failed.")
+
+def refresh_collections():
+    """Function to refresh the list of collections."""
+    clear_collections_cache()
+    # It's safe to use st.toast inside functions too, as long as the
+    # function itself is CALLED after set_page_config has run.
+    if not list_collections():
+         st.toast("Refreshed: No collections found or failed to connect.")
+    else:
+        st.toast("Collections list refreshed.")